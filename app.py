@@ -11,54 +11,131 @@ os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
 os.environ["LANGCHAIN_API_KEY"] = os.environ.get("LANGSMITH_API_KEY", "")
 os.environ["LANGCHAIN_PROJECT"] = "medical-chatbot-render"
 
+# OPTIMIZATION: Upload traces from a background thread, off the request path
+os.environ["LANGCHAIN_CALLBACKS_BACKGROUND"] = "true"
+
 # OPTIMIZATION: Sample traces (1 in 10 requests) to save costs
 os.environ["LANGSMITH_SAMPLE_RATE"] = "0.1"  # 10% sampling rate
 
 print(f"🔍 LangSmith: Tracing enabled with sampling (10%)")
 # =========================================
 
-from flask import Flask, render_template, request, session, jsonify
-from src.helper import download_embeddings
+from flask import Flask, render_template, request, session, jsonify, Response, stream_with_context
+from src.helper import download_embeddings, truncate_input, sort_documents, source_namespace, render_history
 from langchain_pinecone import PineconeVectorStore
+from pinecone.grpc import PineconeGRPC
 from langchain_groq import ChatGroq
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.memory import ConversationBufferMemory
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from cachetools import TTLCache
+from collections import deque
 from src.prompt import *
 import uuid
+import json
+import hashlib
 import logging
-import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+import numpy as np
+import httpx
+import tiktoken
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging - per-request lines are DEBUG, so production (INFO)
+# never formats them
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev-key-change-in-production")
 
+# store_index.py puts each source book in its own Pinecone namespace;
+# only the medical book is indexed, so every query searches that namespace
+NAMESPACE = source_namespace("data/Medical_book.pdf")
+
+# MMR drops near-duplicate chunks from the retrieved context
+SEARCH_KWARGS = {"k": 2, "fetch_k": 10, "lambda_mult": 0.5, "namespace": NAMESPACE}
+
+INDEX_NAME = "medicalchatbot"
+_docsearch = None
+_docsearch_pid = None
+_docsearch_lock = threading.Lock()
+
+def get_docsearch():
+    """Return this process's Pinecone vector store. The gRPC client keeps one
+    long-lived HTTP/2 connection for all queries, but its channel can't be
+    shared across fork, so it is rebuilt whenever the process id changes.
+    Building it checks the index with a stats call, so a bad API key or a
+    missing index fails here rather than on a later query."""
+    global _docsearch, _docsearch_pid
+    with _docsearch_lock:
+        if _docsearch is None or _docsearch_pid != os.getpid():
+            pc = PineconeGRPC(api_key=os.environ.get("PINECONE_API_KEY"))
+            index = pc.Index(INDEX_NAME)
+            index.describe_index_stats()
+            _docsearch = PineconeVectorStore(
+                index=index,
+                embedding=embeddings,
+                text_key="text"
+            )
+            _docsearch_pid = os.getpid()
+        return _docsearch
+
+def retrieve_documents(inputs):
+    """MMR search by vector, reusing the query embedding computed for the
+    answer cache when there is one so the message isn't embedded twice"""
+    vector = inputs.get("query_vector")
+    if vector is None:
+        vector = embeddings.embed_query(inputs["input"])
+    return get_docsearch().max_marginal_relevance_search_by_vector(vector, **SEARCH_KWARGS)
+
 # Initialize components
 try:
     logger.info("Initializing components...")
     embeddings = download_embeddings()
     
-    index_name = "medicalchatbot"
-    docsearch = PineconeVectorStore.from_existing_index(
-        index_name=index_name,
-        embedding=embeddings,
-    )
+    # Warm up the embedding model so the first request doesn't pay for
+    # kernel selection and lazy initialization
+    for _ in range(3):
+        embeddings.embed_query("warmup")
     
-    retriever = docsearch.as_retriever(
-        search_type="similarity", 
-        search_kwargs={"k": 2}
+    # Connect to Pinecone now so a bad key or missing index is caught at
+    # startup and reported by /health, not only on the first chat request
+    get_docsearch()
+    
+    # One pooled keep-alive client shared by all worker threads, so Groq
+    # calls reuse open connections instead of a TLS handshake per request
+    groq_http_client = httpx.Client(
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+        timeout=30
     )
     
     chat_model = ChatGroq(
         model="llama-3.3-70b-versatile",
         temperature=0.1,
-        max_tokens=500
+        max_tokens=500,
+        http_client=groq_http_client
     )
     
+    # Tokenizer used to bound user input; the BPE file may be downloaded on
+    # first use, so it is loaded here where failures leave the app degraded
+    input_encoding = tiktoken.get_encoding("cl100k_base")
+    
+    # Build the RAG chain once - it is immutable and reused by every request
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
+        ("human", human_prompt),
+    ])
+    
+    question_answering_chain = create_stuff_documents_chain(chat_model, prompt)
+    # Sort retrieved chunks into a stable order. Together with the template
+    # order (system, docs, history, input) this keeps the prompt prefix
+    # stable for Groq's prefix cache.
+    retriever = RunnableLambda(retrieve_documents) | RunnableLambda(sort_documents)
+    rag_chain = create_retrieval_chain(retriever, question_answering_chain)
+    
     logger.info("✅ All components initialized")
     
 except Exception as e:
@@ -66,95 +143,265 @@ except Exception as e:
     embeddings = None
     retriever = None
     chat_model = None
+    rag_chain = None
+    input_encoding = None
 
-# Memory storage
-session_memories = {}
+# Memory storage - bounded, idle sessions expire after an hour.
+# Each session keeps its last 6 exchanges as (role, text) tuples.
+session_memories = TTLCache(maxsize=10000, ttl=3600)
+session_memories_lock = threading.Lock()
+MAX_HISTORY_MESSAGES = 12
+session_locks = TTLCache(maxsize=10000, ttl=3600)
 
-def get_or_create_memory(session_id):
-    if session_id not in session_memories:
-        session_memories[session_id] = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
-        )
-    return session_memories[session_id]
+def get_session(session_id):
+    """Return the session's history deque and the lock that guards it"""
+    with session_memories_lock:
+        history = session_memories.get(session_id)
+        if history is None:
+            history = deque(maxlen=MAX_HISTORY_MESSAGES)
+        lock = session_locks.get(session_id)
+        if lock is None:
+            lock = threading.Lock()
+        # TTLCache only sets expiry on insert, so re-insert on every access
+        # to make the TTL measure idle time rather than session age
+        session_memories[session_id] = history
+        session_locks[session_id] = lock
+    return history, lock
+
+def save_turn(session_id, msg, answer):
+    """Append a finished exchange to the session history. Called inline,
+    before the response closes, so the session's next request always sees
+    it and turns land in order."""
+    history, lock = get_session(session_id)
+    with lock:
+        history.extend([("User", msg), ("Assistant", answer)])
+    
+    logger.debug("Bot response (%s): %s...", session_id[:8], answer[:50])
+
+# Inserting into the shared answer cache (re-stacking the embedding matrix)
+# runs here so the response finishes immediately
+cache_executor = ThreadPoolExecutor(max_workers=4)
+
+# ============ ANSWER CACHE ============
+# Exact-match LRU keyed on the normalized question, plus a semantic cache
+# that reuses an answer when a new question embeds close to an old one.
+# Only first-turn questions are cached: answers that depend on chat
+# history are never shared between sessions.
+EXACT_CACHE_SIZE = 512
+SEMANTIC_CACHE_SIZE = 1024
+SEMANTIC_THRESHOLD = 0.95
+
+_exact_cache = OrderedDict()
+_semantic_vectors = np.empty((0, 384), dtype=np.float32)
+_semantic_answers = []
+_cache_lock = threading.Lock()
+
+def normalize_query(msg):
+    return " ".join(msg.lower().split())
+
+def embed_for_cache(msg):
+    # Embeddings are already L2-normalized, so a dot product is the cosine
+    return np.asarray(embeddings.embed_query(msg), dtype=np.float32)
+
+def get_cached_answer(query, vector=None):
+    with _cache_lock:
+        if query in _exact_cache:
+            _exact_cache.move_to_end(query)
+            return _exact_cache[query]
+        if vector is None or not _semantic_answers:
+            return None
+        scores = _semantic_vectors @ vector
+        best = int(np.argmax(scores))
+        if scores[best] > SEMANTIC_THRESHOLD:
+            return _semantic_answers[best]
+    return None
+
+def cache_answer(query, vector, answer):
+    global _semantic_vectors
+    with _cache_lock:
+        _exact_cache[query] = answer
+        _exact_cache.move_to_end(query)
+        if len(_exact_cache) > EXACT_CACHE_SIZE:
+            _exact_cache.popitem(last=False)
+        # FIFO eviction keeps the vectors in one contiguous matrix
+        _semantic_vectors = np.vstack([_semantic_vectors, vector])[-SEMANTIC_CACHE_SIZE:]
+        _semantic_answers.append(answer)
+        del _semantic_answers[:-SEMANTIC_CACHE_SIZE]
+# ======================================
+
+# ============ REQUEST COALESCING ============
+# Identical questions arriving while one is already being answered wait for
+# that answer instead of running the chain again. The key covers the exact
+# message and the full rendered history, so a waiter only ever gets the
+# answer to the very prompt it would have sent and never one built from
+# another session's conversation.
+INFLIGHT_TIMEOUT = 60
+
+class InflightQuery:
+    def __init__(self):
+        self.done = threading.Event()
+        self.answer = None
+
+INFLIGHT = {}
+_inflight_lock = threading.Lock()
+
+def coalesce_key(msg, chat_history):
+    return hashlib.sha1(repr((msg, chat_history)).encode("utf-8")).hexdigest()
+
+def join_inflight(key):
+    """Return the in-flight entry for key and whether this caller must compute it"""
+    with _inflight_lock:
+        entry = INFLIGHT.get(key)
+        if entry is not None:
+            return entry, False
+        entry = INFLIGHT[key] = InflightQuery()
+        return entry, True
+
+def resolve_inflight(key, entry, answer):
+    """Publish the answer (None on failure) to waiting requests and drop the
+    entry. Only the first call for an entry takes effect, so fallbacks can
+    call it unconditionally."""
+    with _inflight_lock:
+        if entry.done.is_set():
+            return
+        if INFLIGHT.get(key) is entry:
+            del INFLIGHT[key]
+        entry.answer = answer
+        entry.done.set()
+# ============================================
+
+# ============ STREAMING ============
+def sse_event(text):
+    """Format one Server-Sent Event; JSON keeps newlines inside a single data line"""
+    return f"data: {json.dumps(text)}\n\n"
+
+def sse_response(events):
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def sse_message(text):
+    """Send a complete message as a single-event stream"""
+    return sse_response(iter([sse_event(text)]))
+# ===================================
 
 @app.route('/')
 def index():
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
     
-    get_or_create_memory(session['session_id'])
     return render_template('chat.html')
 
 @app.route('/get', methods=["POST"])
 def chat():
-    """Handle chat messages with optimized LangSmith tracing"""
+    """Stream chat answers token by token with optimized LangSmith tracing"""
+    inflight = None
+    is_leader = False
     try:
         session_id = session.get('session_id')
         if not session_id:
-            return "Session expired. Please refresh the page."
+            return sse_message("Session expired. Please refresh the page.")
         
-        msg = request.form['msg']
-        logger.info(f"User ({session_id[:8]}): {msg[:50]}...")
+        msg = request.form.get('msg', '').strip()
+        if not msg:
+            return sse_message("Please enter a question."), 400
         
-        if not all([chat_model, retriever]):
-            return "Service is initializing. Please try again in 30 seconds."
+        if not all([chat_model, retriever, rag_chain, input_encoding]):
+            return sse_message("Service is initializing. Please try again in 30 seconds.")
         
-        memory = get_or_create_memory(session_id)
-        memory_vars = memory.load_memory_variables({})
-        chat_history = memory_vars.get("chat_history", [])
+        msg = truncate_input(msg, input_encoding)
+        logger.debug("User (%s): %s...", session_id[:8], msg[:50])
         
-        # ============ OPTIMIZED TRACING ============
-        # Use LangChain's auto-tracing (already enabled via env vars)
-        # No need for manual trace() calls - saves overhead
+        history, lock = get_session(session_id)
+        with lock:
+            chat_history = render_history(history)
+            history_size = len(history)
         
-        # Create and execute chain (automatically traced by LangSmith)
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", system_prompt),
-            MessagesPlaceholder(variable_name="chat_history"),
-            ("human", "{input}"),
-        ])
-        
-        question_answering_chain = create_stuff_documents_chain(chat_model, prompt)
-        rag_chain = create_retrieval_chain(retriever, question_answering_chain)
-        
-        response = rag_chain.invoke({
-            "input": msg,
-            "chat_history": chat_history
-        })
+        # Serve repeated first-turn questions from the answer cache
+        query = normalize_query(msg)
+        query_vector = None
+        if not chat_history:
+            answer = get_cached_answer(query)
+            if answer is None:
+                query_vector = embed_for_cache(msg)
+                answer = get_cached_answer(query, query_vector)
+            if answer is not None:
+                save_turn(session_id, msg, answer)
+                return sse_message(answer)
         
-        answer = response['answer']
+        # Wait for an identical in-flight question instead of recomputing it
+        inflight_key = coalesce_key(msg, chat_history)
+        inflight, is_leader = join_inflight(inflight_key)
+        if not is_leader:
+            if not inflight.done.wait(INFLIGHT_TIMEOUT):
+                resolve_inflight(inflight_key, inflight, None)
+            if not inflight.answer:
+                return sse_message("I'm having trouble processing your request. Please try again.")
+            save_turn(session_id, msg, inflight.answer)
+            return sse_message(inflight.answer)
         
-        # Save to memory
-        memory.save_context({"input": msg}, {"output": answer})
+        # ============ OPTIMIZED TRACING ============
+        # Use LangChain's auto-tracing (already enabled via env vars)
+        # No need for manual trace() calls - saves overhead
         
-        # Log to LangSmith via metadata (optional)
-        try:
-            from langsmith import trace
-            
-            # Add custom metadata with low overhead
-            trace.get_current_run().metadata.update({
+        # Custom metadata rides along with the background trace upload
+        config = RunnableConfig(
+            metadata={
                 "session_id": session_id[:8],
-                "memory_size": len(chat_history),
-                "sampled": random.random() < 0.1  # Mark if sampled
-            })
-        except:
-            pass  # Silently fail if LangSmith not available
-        
-        logger.info(f"Bot response ({session_id[:8]}): {answer[:50]}...")
-        return answer
+                "memory_size": history_size
+            },
+            tags=["medical"]
+        )
         
     except Exception as e:
-        logger.error(f"Chat error: {e}", exc_info=True)
+        logger.error("Chat error: %s", e, exc_info=True)
         
-        # Log error to LangSmith
-        try:
-            from langsmith import trace
-            trace.get_current_run().tags.append("error")
-        except:
-            pass
+        # Don't leave identical questions waiting on an entry nobody will fill
+        if is_leader:
+            resolve_inflight(inflight_key, inflight, None)
         
-        return "I'm having trouble processing your request. Please try again."
+        return sse_message("I'm having trouble processing your request. Please try again.")
+    
+    def generate():
+        answer_parts = []
+        completed = False
+        try:
+            # Execute the prebuilt chain (automatically traced by LangSmith)
+            for chunk in rag_chain.stream({
+                "input": msg,
+                "chat_history": chat_history,
+                "query_vector": query_vector.tolist() if query_vector is not None else None
+            }, config=config):
+                token = chunk.get("answer", "")
+                if token:
+                    answer_parts.append(token)
+                    yield sse_event(token)
+            completed = True
+        except Exception as e:
+            logger.error("Chat error: %s", e, exc_info=True)
+            
+            if not answer_parts:
+                yield sse_event("I'm having trouble processing your request. Please try again.")
+        finally:
+            answer = "".join(answer_parts)
+            resolve_inflight(inflight_key, inflight, answer if completed else None)
+            # A cut-off answer (client disconnect or LLM error mid-stream) is
+            # neither cached nor kept in history, so it can't be served or
+            # built upon later
+            if completed and answer:
+                save_turn(session_id, msg, answer)
+                if query_vector is not None:
+                    cache_executor.submit(cache_answer, query, query_vector, answer)
+            elif answer:
+                logger.debug("Dropped partial response (%s): %s...", session_id[:8], answer[:50])
+    
+    response = sse_response(generate())
+    # Fallback for when the server closes the response before generate()
+    # ever runs, so its finally block never resolves the in-flight entry
+    response.call_on_close(lambda: resolve_inflight(inflight_key, inflight, None))
+    return response
 
 @app.route('/health')
 def health():
@@ -171,7 +418,7 @@ def health():
         "status": "healthy",
         "langsmith": langsmith_status,
         "components": {
-            "pinecone": bool(retriever),
+            "pinecone": _docsearch is not None,
             "groq": bool(chat_model),
             "embeddings": bool(embeddings)
         }
@@ -234,4 +481,4 @@ if __name__ == '__main__':
     logger.info(f"📊 Health: http://localhost:{port}/health")
     logger.info(f"🧪 LangSmith test: http://localhost:{port}/langsmith-test")
     
-    app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=port, debug=False, threaded=True)
\ No newline at end of file
@@ -1,8 +1,30 @@
+import os
+
+# On Render, model weights (and the quantized ONNX export) are built into the
+# project directory by render.yaml's buildCommand and shipped with the deploy,
+# so booting the service doesn't download or export anything
+if os.environ.get("RENDER"):
+    os.environ.setdefault("HF_HOME", "/opt/render/project/src/.cache/hf")
+
 from langchain.document_loaders import PyPDFLoader, DirectoryLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.embeddings import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 from typing import List
+from pathlib import PureWindowsPath
 from langchain.schema import Document
+import numpy as np
+import logging
+import shutil
+
+try:
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+except ImportError:
+    ORTModelForFeatureExtraction = None
+
+logger = logging.getLogger(__name__)
 
 
 #Extract text from pdf files
@@ -42,12 +64,154 @@ def text_split(minimal_docs):
     return text_chunks
 
 
+def source_namespace(source: str) -> str:
+    """
+    Return the Pinecone namespace for a source file: its file name without
+    extension, e.g. 'data/Medical_book.pdf' -> 'Medical_book'.
+    """
+    return PureWindowsPath(source).stem
+
+
+def render_history(history) -> str:
+    """
+    Render (role, text) conversation turns as plain "Role: text" lines for
+    direct substitution into the prompt.
+    """
+    return "\n".join(f"{role}: {text}" for role, text in history)
+
+
+def truncate_input(msg: str, encoding, max_tokens: int = 512) -> str:
+    """
+    Cut a user message down to max_tokens tokens of the given tiktoken
+    encoding, so oversized input can't blow up embedding and prompt size.
+    """
+    tokens = encoding.encode(msg)
+    if len(tokens) <= max_tokens:
+        return msg
+    return encoding.decode(tokens[:max_tokens])
+
+
+def sort_documents(docs: List[Document]) -> List[Document]:
+    """
+    Order retrieved Documents deterministically by source, page and content,
+    so the same chunks always produce the same prompt prefix.
+    """
+    return sorted(
+        docs,
+        key=lambda doc: (
+            doc.metadata.get("source") or "",
+            doc.metadata.get("page", 0),
+            doc.page_content,
+        )
+    )
+
+
+class ONNXEmbeddings(Embeddings):
+    """
+    Sentence-transformers model exported to ONNX with dynamic int8
+    quantization, run on the ONNX Runtime CPU provider. Output matches the
+    sentence-transformers pipeline: inputs truncated to max_seq_length tokens,
+    mean pooling, then L2 normalization.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str, batch_size: int = 128, max_seq_length: int = 256):
+        model_dir = os.path.join(cache_dir, model_name.replace("/", "--") + "-int8")
+        if not os.path.exists(os.path.join(model_dir, self.COMPLETE_MARKER)):
+            self._build(model_name, model_dir)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name="model_quantized.onnx",
+            provider="CPUExecutionProvider"
+        )
+        self.session = self.model.model
+        self.input_names = {node.name for node in self.session.get_inputs()}
+        self.batch_size = batch_size
+        self.max_seq_length = max_seq_length
+
+    # Written last into a finished build; its absence means the cache is missing or partial
+    COMPLETE_MARKER = ".complete"
+
+    def _build(self, model_name: str, model_dir: str) -> None:
+        """
+        Export, quantize and save the tokenizer into a temp dir next to
+        model_dir, then move it into place, so an interrupted build never
+        leaves a half-written model_dir behind.
+        """
+        tmp_dir = f"{model_dir}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+        quantizer = ORTQuantizer.from_pretrained(model)
+        quantizer.quantize(
+            save_dir=tmp_dir,
+            quantization_config=AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+        )
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(tmp_dir)
+        open(os.path.join(tmp_dir, self.COMPLETE_MARKER), "w").close()
+
+        # Clear leftovers from an earlier interrupted build before swapping in
+        shutil.rmtree(model_dir, ignore_errors=True)
+        os.replace(tmp_dir, model_dir)
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_tensors="np"
+        )
+        feed = {name: value.astype(np.int64) for name, value in inputs.items() if name in self.input_names}
+        token_embeddings = self.session.run(None, feed)[0]
+
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [
+            self._embed(texts[i:i + self.batch_size])
+            for i in range(0, len(texts), self.batch_size)
+        ]
+        return np.vstack(vectors).tolist() if vectors else []
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
+
+
 def download_embeddings():
     """
-    Download and return the HuggingFace embeddings model.
+    Download and return the embeddings model. Uses the int8 ONNX Runtime
+    model when optimum is installed, otherwise the PyTorch HuggingFace model.
     """
     model_name = "sentence-transformers/all-MiniLM-L6-v2"
+    if ORTModelForFeatureExtraction is not None:
+        hf_home = os.environ.get("HF_HOME", os.path.join(os.path.expanduser("~"), ".cache", "huggingface"))
+        cache_dir = os.path.join(hf_home, "onnx")
+        return ONNXEmbeddings(model_name, cache_dir)
+
     embeddings = HuggingFaceEmbeddings(
-        model_name = model_name
+        model_name = model_name,
+        encode_kwargs = {"batch_size": 128, "normalize_embeddings": True}
     )
+
+    # Compile the transformer forward pass on PyTorch 2.x (opt out with
+    # EMBEDDINGS_TORCH_COMPILE=0). The wrapping SentenceTransformer is left as
+    # is so encode() keeps working; dynamic shapes avoid a recompile for every
+    # new sequence length. Compilation happens on the first forward pass and
+    # needs a working C++ toolchain on CPU, so run one embed here and fall
+    # back to eager mode if anything fails.
+    import torch
+    if hasattr(torch, "compile") and os.environ.get("EMBEDDINGS_TORCH_COMPILE", "1") != "0":
+        transformer = embeddings.client[0]
+        eager_model = transformer.auto_model
+        try:
+            transformer.auto_model = torch.compile(eager_model, dynamic=True)
+            embeddings.embed_query("warmup")
+        except Exception as e:
+            logger.warning("torch.compile unavailable, using eager embeddings: %s", e)
+            transformer.auto_model = eager_model
     return embeddings
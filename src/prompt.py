@@ -6,4 +6,11 @@ system_prompt = (
     "Use three sentences maximum and keep the answer concise." 
     "\n\n"
     "{context}"  
-)
\ No newline at end of file
+)
+
+# Human turn: the pre-rendered conversation history followed by the new
+# user input, so no MessagesPlaceholder expansion is needed per request
+human_prompt = (
+    "{chat_history}\n"
+    "User: {input}"
+)
@@ -1,9 +1,11 @@
 from dotenv import load_dotenv
 import os 
-from src.helper import load_pdf_files, filter_to_minimal_docs, text_split, download_embeddings 
+import sys
+from src.helper import load_pdf_files, filter_to_minimal_docs, text_split, download_embeddings, source_namespace
 from pinecone import Pinecone
 from pinecone import ServerlessSpec
 from langchain_pinecone import PineconeVectorStore
+import uuid
 
 load_dotenv()
 
@@ -24,20 +26,46 @@ pc = Pinecone(api_key=pinecone_api_key)
 
 index_name = "medicalchatbot"
 
+#embeddings are unit-length, so dot product equals cosine without per-query norms.
+#an existing index with another metric is only replaced when asked explicitly:
+#    python store_index.py --recreate-index
+if pc.has_index(index_name) and pc.describe_index(index_name).metric != "dotproduct":
+    if "--recreate-index" not in sys.argv:
+        sys.exit(
+            f"Index '{index_name}' uses metric '{pc.describe_index(index_name).metric}', not 'dotproduct'. "
+            "Re-run with --recreate-index to delete and rebuild it (the app is unavailable until indexing finishes)."
+        )
+    pc.delete_index(index_name)
+
 if not pc.has_index(index_name):
     pc.create_index(
         name=index_name,
         dimension=384,
-        metric="cosine",
+        metric="dotproduct",
         spec=ServerlessSpec(cloud="aws", region="us-east-1")
     )
 
-index = pc.Index(index_name)
+index = pc.Index(index_name, pool_threads=8)
 #Load index
 
-#embed each pine chunk and upset the embeddings into pinecone index
-docsearch = PineconeVectorStore.from_documents(
-    documents=text_chunks,
-    index_name=index_name,
-    embedding=embeddings,
-    )
\ No newline at end of file
+#embed all chunks in large batches, then upsert them in parallel batches
+texts = [chunk.page_content for chunk in text_chunks]
+vectors = embeddings.embed_documents(texts)
+metadatas = [{**chunk.metadata, "text": chunk.page_content} for chunk in text_chunks]
+ids = [str(uuid.uuid4()) for _ in text_chunks]
+
+#each source book gets its own namespace so queries only scan that shard
+namespaces = {}
+for record in zip(ids, vectors, metadatas):
+    namespaces.setdefault(source_namespace(record[2]["source"]), []).append(record)
+
+batch_size = 100
+async_results = [
+    index.upsert(vectors=records[i:i + batch_size], namespace=namespace, async_req=True)
+    for namespace, records in namespaces.items()
+    for i in range(0, len(records), batch_size)
+]
+for result in async_results:
+    result.get()
+
+docsearch = PineconeVectorStore(index=index, embedding=embeddings, text_key="text")
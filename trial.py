@@ -10,21 +10,32 @@ os.environ["LANGCHAIN_TRACING_V2"] = "true"
 os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
 os.environ["LANGCHAIN_API_KEY"] = os.environ.get("LANGSMITH_API_KEY")
 os.environ["LANGCHAIN_PROJECT"] = "medical-chatbot"
+os.environ["LANGCHAIN_CALLBACKS_BACKGROUND"] = "true"
 
 print(f"🔍 LangSmith Tracing: {'✅ Enabled' if os.environ.get('LANGCHAIN_TRACING_V2') == 'true' else '❌ Disabled'}")
 print(f"🔑 LangSmith API Key: {'✅ Set' if os.environ.get('LANGCHAIN_API_KEY') else '❌ Not Set'}")
 # =========================================
 
-from flask import Flask, render_template, request, session
-from src.helper import download_embeddings
+from flask import Flask, render_template, request, session, Response, stream_with_context
+from src.helper import download_embeddings, truncate_input, sort_documents, source_namespace, render_history
 from langchain_pinecone import PineconeVectorStore
+from pinecone.grpc import PineconeGRPC
 from langchain_groq import ChatGroq
 from langchain.chains import create_retrieval_chain
 from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain.memory import ConversationBufferMemory
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig, RunnableLambda
+from cachetools import TTLCache
+from collections import deque
 from src.prompt import *
 import uuid
+import tiktoken
+import json
+import logging
+import threading
+
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"))
+logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24).hex()
@@ -32,119 +43,113 @@ app.secret_key = os.urandom(24).hex()
 # Initialize components
 embeddings = download_embeddings()
 index_name = "medicalchatbot"
-docsearch = PineconeVectorStore.from_existing_index(
-    index_name=index_name,
+# gRPC client keeps one long-lived HTTP/2 connection for all queries
+pc = PineconeGRPC(api_key=os.environ.get("PINECONE_API_KEY"))
+index = pc.Index(index_name)
+docsearch = PineconeVectorStore(
+    index=index,
     embedding=embeddings,
+    text_key="text"
+)
+retriever = docsearch.as_retriever(
+    search_type="mmr",
+    search_kwargs={"k": 2, "fetch_k": 10, "lambda_mult": 0.5, "namespace": source_namespace("data/Medical_book.pdf")}
 )
-retriever = docsearch.as_retriever(search_type="similarity", search_kwargs={"k": 3})
 chat_model = ChatGroq(model="llama-3.3-70b-versatile")
+input_encoding = tiktoken.get_encoding("cl100k_base")
+
+# Build the RAG chain once and reuse it for every request
+prompt = ChatPromptTemplate.from_messages([
+    ("system", system_prompt),
+    ("human", human_prompt),
+])
+question_answering_chain = create_stuff_documents_chain(chat_model, prompt)
+sorted_retriever = (
+    RunnableLambda(lambda x: x["input"])
+    | retriever
+    | RunnableLambda(sort_documents)
+)
+rag_chain = create_retrieval_chain(sorted_retriever, question_answering_chain)
 
-# Memory storage
-session_memories = {}
+# Memory storage - bounded, idle sessions expire after an hour.
+# Each session keeps its last 6 exchanges as (role, text) tuples.
+session_memories = TTLCache(maxsize=10000, ttl=3600)
+session_memories_lock = threading.Lock()
+MAX_HISTORY_MESSAGES = 12
 
-def get_or_create_memory(session_id):
-    if session_id not in session_memories:
-        session_memories[session_id] = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
-        )
-    return session_memories[session_id]
+def sse_event(text):
+    return f"data: {json.dumps(text)}\n\n"
+
+def sse_response(events):
+    return Response(stream_with_context(events), mimetype="text/event-stream")
 
 @app.route('/')
 def index():
     if 'session_id' not in session:
         session['session_id'] = str(uuid.uuid4())
-        print(f"🆕 New session: {session['session_id'][:8]}")
+        logger.debug("🆕 New session: %s", session['session_id'][:8])
     
-    get_or_create_memory(session['session_id'])
     return render_template('chat.html')
 
 @app.route('/get', methods=["POST"])
 def chat():
-    try:
-        session_id = session.get('session_id')
-        if not session_id:
-            return "Please refresh the page."
-        
-        msg = request.form['msg']
-        print(f"\n📥 User ({session_id[:8]}): {msg}")
-        
-        memory = get_or_create_memory(session_id)
-        memory_vars = memory.load_memory_variables({})
-        chat_history = memory_vars.get("chat_history", [])
-        
-        # ============ VERSION-AGNOSTIC TRACING ============
-        # Method that works with all LangSmith versions
-        import langsmith
-        from langsmith import trace
-        
-        # Prepare metadata
-        metadata = {
-            "session": session_id[:8],
-            "memory_messages": len(memory.chat_memory.messages),
-            "query": msg[:100]
-        }
-        
-        # Check LangSmith version and use appropriate method
+    session_id = session.get('session_id')
+    if not session_id:
+        return sse_response(iter([sse_event("Please refresh the page.")]))
+    
+    msg = request.form.get('msg', '').strip()
+    if not msg:
+        return sse_response(iter([sse_event("Please enter a question.")])), 400
+    
+    msg = truncate_input(msg, input_encoding)
+    logger.debug("📥 User (%s): %s", session_id[:8], msg)
+    
+    def generate():
+        answer_parts = []
         try:
-            # Try new version API first
-            with trace(
-                name="Medical_Chat_Query",
-                run_type="chain",
-                metadata=metadata,
+            with session_memories_lock:
+                history = session_memories.get(session_id)
+                if history is None:
+                    history = deque(maxlen=MAX_HISTORY_MESSAGES)
+                # Re-insert on every access so the TTL measures idle time
+                session_memories[session_id] = history
+            chat_history = render_history(history)
+            
+            # ============ BACKGROUND TRACING ============
+            # Auto-tracing already captures the chain; metadata is attached via
+            # the run config and uploaded from LangSmith's background thread
+            config = RunnableConfig(
+                metadata={
+                    "session": session_id[:8],
+                    "memory_messages": len(history),
+                    "query": msg[:100]
+                },
                 tags=["medical", f"session_{session_id[:4]}"]
-            ):
-                # Execute RAG chain
-                prompt = ChatPromptTemplate.from_messages([
-                    ("system", system_prompt),
-                    MessagesPlaceholder(variable_name="chat_history"),
-                    ("human", "{input}"),
-                ])
-                
-                question_answering_chain = create_stuff_documents_chain(chat_model, prompt)
-                rag_chain = create_retrieval_chain(retriever, question_answering_chain)
-                
-                response = rag_chain.invoke({
-                    "input": msg,
-                    "chat_history": chat_history
-                })
-                answer = response['answer']
-                
-        except TypeError as e:
-            # Fallback: Old version without metadata parameter
-            print(f"⚠️ Using fallback tracing (old API): {e}")
+            )
             
-            # Just trace without metadata
-            with trace(name="Medical_Chat", run_type="chain"):
-                prompt = ChatPromptTemplate.from_messages([
-                    ("system", system_prompt),
-                    MessagesPlaceholder(variable_name="chat_history"),
-                    ("human", "{input}"),
-                ])
-                
-                question_answering_chain = create_stuff_documents_chain(chat_model, prompt)
-                rag_chain = create_retrieval_chain(retriever, question_answering_chain)
-                
-                response = rag_chain.invoke({
-                    "input": msg,
-                    "chat_history": chat_history
-                })
-                answer = response['answer']
-        # ==================================================
-        
-        # Save to memory
-        memory.save_context({"input": msg}, {"output": answer})
-        
-        print(f"🤖 Bot: {answer[:100]}...")
-        print(f"🧠 Memory now has {len(memory.chat_memory.messages)} messages")
-        
-        return answer
-        
-    except Exception as e:
-        print(f"❌ Error: {e}")
-        import traceback
-        traceback.print_exc()
-        return "I'm having trouble processing your request."
+            for chunk in rag_chain.stream({
+                "input": msg,
+                "chat_history": chat_history
+            }, config=config):
+                token = chunk.get("answer", "")
+                if token:
+                    answer_parts.append(token)
+                    yield sse_event(token)
+            # ============================================
+            
+            # Save to memory
+            answer = "".join(answer_parts)
+            history.extend([("User", msg), ("Assistant", answer)])
+            
+            logger.debug("🤖 Bot: %s...", answer[:100])
+            logger.debug("🧠 Memory now has %d messages", len(history))
+            
+        except Exception as e:
+            logger.error("❌ Error: %s", e, exc_info=True)
+            if not answer_parts:
+                yield sse_event("I'm having trouble processing your request.")
+    
+    return sse_response(generate())
 
 @app.route('/debug_trace')
 def debug_trace():